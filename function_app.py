@@ -1,9 +1,13 @@
 import azure.functions as func
 import logging
 import json
+import http.cookiejar
 import requests
 import re
-from urllib.parse import urlencode, urlparse
+from functools import lru_cache, wraps
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlencode, urlsplit, urlunsplit
 
 # Define allowed patterns (wildcards supported)
 ALLOWED_PATTERNS = [
@@ -20,231 +24,212 @@ ALLOWED_PATTERNS = [
     # Add your specific domains here for production
 ]
 
-# Compile wildcard patterns to regex
+# Split patterns into exact hostnames and a single combined wildcard regex
 def compile_patterns(patterns):
-    regex_patterns = []
-    for pattern in patterns:
-        regex_pattern = re.escape(pattern).replace(r"\*", ".*")
-        regex_pattern = f"^{regex_pattern}$"
-        regex_patterns.append(re.compile(regex_pattern, re.IGNORECASE))
-    return regex_patterns
+    literals = frozenset(p.lower() for p in patterns if "*" not in p)
+    wildcards = [re.escape(p).replace(r"\*", ".*") for p in patterns if "*" in p]
+    if not wildcards:
+        return literals, None
+    combined = re.compile(f"^(?:{'|'.join(wildcards)})$", re.IGNORECASE)
+    return literals, combined
 
-REGEX_PATTERNS = compile_patterns(ALLOWED_PATTERNS)
+LITERAL_PATTERNS, COMBINED_PATTERN = compile_patterns(ALLOWED_PATTERNS)
+_ALLOW_ALL = "*" in ALLOWED_PATTERNS
+
+# Extracts the hostname (without scheme, port or path) from a target URL
+_HOST_RE = re.compile(r"^(?:https?://)?([^/:?#]+)", re.IGNORECASE)
 
 def is_allowed(endpoint: str) -> bool:
-    parsed = urlparse(endpoint)
-    domain = parsed.netloc or parsed.path.split("/")[0]
-    # Handle cases where netloc might include port
-    if ':' in domain:
-        domain = domain.split(':')[0]
-    for regex in REGEX_PATTERNS:
-        if regex.match(domain):
-            return True
-    return False
+    if _ALLOW_ALL:
+        return True
+    match = _HOST_RE.match(endpoint)
+    return _is_domain_allowed(match.group(1).lower() if match else "")
+
+# Cached per hostname so requests to different paths on the same host share an entry
+@lru_cache(maxsize=512)
+def _is_domain_allowed(domain: str) -> bool:
+    if domain in LITERAL_PATTERNS:
+        return True
+    return COMBINED_PATTERN is not None and COMBINED_PATTERN.match(domain) is not None
+
+# Append forwarded query parameters, keeping any query already on the target URL
+def append_query(url: str, params) -> str:
+    if not params:
+        return url
+    parts = urlsplit(url)
+    query = urlencode(params, doseq=True)
+    if parts.query:
+        query = f"{parts.query}&{query}"
+    return urlunsplit(parts._replace(query=query))
+
+# Hop-by-hop headers that must not be forwarded
+_HOP_BY_HOP_REQ = frozenset({"host", "connection", "content-length", "transfer-encoding"})
+_HOP_BY_HOP_REQ_ODATA = _HOP_BY_HOP_REQ | {"accept", "content-type"}
+_HOP_BY_HOP_RESP = frozenset({"content-encoding", "content-length", "transfer-encoding", "connection"})
+
+# Shared session so warm workers reuse pooled keep-alive connections to upstreams
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    # Only retry failed connection attempts; upstream responses (including 5xx and Retry-After) pass straight through
+    max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.1,
+                      respect_retry_after_header=False, raise_on_status=False)
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({"User-Agent": "function-proxy/1.0"})
+# The session is shared by every caller, so never store upstream cookies in it;
+# Set-Cookie still reaches the client through the relayed response headers
+SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+# Session.send() skips requests' environment merge, so resolve the TLS verify setting
+# (REQUESTS_CA_BUNDLE / CURL_CA_BUNDLE overrides) once here; proxies are still resolved by send()
+_TLS_VERIFY = SESSION.merge_environment_settings("https://", {}, None, True, None)["verify"]
+
+# Static health check payload, serialized once
+_HEALTHY_BODY = b'{"status": "healthy"}'
+
+# Build a JSON error response; json.dumps only escapes the message itself
+def _json_error(error_msg: str, status_code: int) -> func.HttpResponse:
+    return func.HttpResponse(
+        f'{{"error": {json.dumps(error_msg)}}}'.encode(),
+        status_code=status_code,
+        mimetype="application/json"
+    )
+
+# Turn unexpected exceptions in a route handler into a logged JSON 500 response
+def _safe_handler(error_prefix: str):
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(req: func.HttpRequest) -> func.HttpResponse:
+            try:
+                return handler(req)
+            except Exception as e:
+                error_msg = f"{error_prefix}: {str(e)}"
+                logging.error(error_msg)
+                return _json_error(error_msg, 500)
+        return wrapper
+    return decorator
+
+# Default headers sent with every OData request
+_ODATA_HEADERS = {
+    'Accept': 'application/json;odata.metadata=minimal',
+    'Content-Type': 'application/json',
+    'OData-Version': '4.0'
+}
+
+# Forward a request to target_url and relay the upstream response; shared by both proxy routes
+def _do_proxy(req: func.HttpRequest, method: str, target_url: str, query_params, *,
+              label: str = "", request_error: str = "Request failed",
+              base_headers=None, excluded_headers=_HOP_BY_HOP_REQ) -> func.HttpResponse:
+    is_https = target_url.startswith("https://")
+    target_url = append_query(target_url, query_params)
+
+    # Prepare headers (exclude hop-by-hop headers)
+    headers = dict(base_headers) if base_headers else {}
+    headers.update({k: v for k, v in req.headers.items() if k.lower() not in excluded_headers})
+
+    # Request body for applicable methods (skip the host binding read when it is known to be empty)
+    body = None
+    if method in ('POST', 'PUT', 'PATCH') and req.headers.get('Content-Length') != '0':
+        body = req.get_body() or None
+
+    logging.info("Proxying %s%s request to: %s", label, method, target_url)
+
+    try:
+        # The query is already merged into target_url, so prepare once and send directly
+        prepped = SESSION.prepare_request(requests.Request(method=method, url=target_url, headers=headers, data=body))
+        response = SESSION.send(prepped, timeout=30, verify=_TLS_VERIFY if is_https else False, allow_redirects=True)
+    except requests.exceptions.RequestException as e:
+        error_msg = f"{request_error}: {str(e)}"
+        logging.error(error_msg)
+        return _json_error(error_msg, 502)
+
+    # Filter response headers
+    response_headers = {k: v for k, v in response.headers.items() if k.lower() not in _HOP_BY_HOP_RESP}
+
+    # Upstream content-type is already relayed in response_headers; mimetype only covers its absence
+    content_type = response.headers.get('content-type')
+    # azure-functions HttpResponse only accepts a complete body, so the upstream response is not streamed
+    return func.HttpResponse(
+        body=response.content,
+        status_code=response.status_code,
+        headers=response_headers,
+        mimetype=content_type or 'application/json'
+    )
 
 app = func.FunctionApp()
 
 @app.route(route="proxy/{*endpoint}", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+@_safe_handler("Internal server error")
 def proxy_function(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        endpoint = req.route_params.get('endpoint')
-        if not endpoint:
-            error_msg = "No endpoint specified"
-            logging.error(error_msg)
-            return func.HttpResponse(
-                json.dumps({"error": error_msg}),
-                status_code=400,
-                mimetype="application/json"
-            )
-
-        # Check for scheme override parameter (using an unlikely parameter name)
-        scheme_override = req.params.get('__proxy_scheme')
-        
-        # Determine scheme
-        if endpoint.startswith("http://") or endpoint.startswith("https://"):
-            target_url = endpoint
-        elif scheme_override:
-            if scheme_override.lower() in ['http', 'https']:
-                target_url = f"{scheme_override.lower()}://{endpoint}"
-            else:
-                error_msg = f"Invalid scheme: {scheme_override}. Only 'http' and 'https' are allowed."
-                logging.error(error_msg)
-                return func.HttpResponse(
-                    json.dumps({"error": error_msg}),
-                    status_code=400,
-                    mimetype="application/json"
-                )
+    method = req.method.upper()
+    endpoint = req.route_params.get('endpoint')
+    if not endpoint:
+        error_msg = "No endpoint specified"
+        logging.error(error_msg)
+        return _json_error(error_msg, 400)
+
+    # Check for scheme override parameter (using an unlikely parameter name)
+    scheme_override = req.params.get('__proxy_scheme')
+    
+    # Determine scheme
+    if endpoint.startswith(("http://", "https://")):
+        target_url = endpoint
+    elif scheme_override:
+        scheme = scheme_override.lower()
+        if scheme in ('http', 'https'):
+            target_url = f"{scheme}://{endpoint}"
         else:
-            target_url = f"https://{endpoint}"
-
-        # Allowlist check
-        if not is_allowed(target_url):
-            error_msg = f"Endpoint not allowed: {target_url}"
+            error_msg = f"Invalid scheme: {scheme_override}. Only 'http' and 'https' are allowed."
             logging.error(error_msg)
-            return func.HttpResponse(
-                json.dumps({"error": error_msg}),
-                status_code=403,
-                mimetype="application/json"
-            )
-
-        # Query parameters (exclude our special parameter)
-        query_params = {k: v for k, v in req.params.items() if k != '__proxy_scheme'}
-        if query_params:
-            delimiter = "&" if "?" in target_url else "?"
-            target_url += delimiter + urlencode(query_params)
-
-        method = req.method.upper()
-
-        # Prepare headers (exclude hop-by-hop headers)
-        headers = {}
-        for key, value in req.headers.items():
-            if key.lower() not in ['host', 'connection', 'content-length', 'transfer-encoding']:
-                headers[key] = value
-
-        # Request body for applicable methods
-        body = None
-        if method in ['POST', 'PUT', 'PATCH']:
-            try:
-                body = req.get_body()
-            except Exception as e:
-                logging.warning(f"Could not read request body: {e}")
-
-        logging.info(f"Proxying {method} request to: {target_url}")
-
-        response = requests.request(
-            method=method,
-            url=target_url,
-            headers=headers,
-            data=body,
-            timeout=30,
-            verify=target_url.startswith("https://")
-        )
-
-        # Filter response headers
-        response_headers = {}
-        for key, value in response.headers.items():
-            if key.lower() not in ['content-encoding', 'content-length', 'transfer-encoding', 'connection']:
-                response_headers[key] = value
-
-        return func.HttpResponse(
-            body=response.content,
-            status_code=response.status_code,
-            headers=response_headers,
-            mimetype=response.headers.get('content-type', 'application/json')
-        )
+            return _json_error(error_msg, 400)
+    else:
+        target_url = f"https://{endpoint}"
 
-    except requests.exceptions.RequestException as e:
-        error_msg = f"Request failed: {str(e)}"
-        logging.error(error_msg)
-        return func.HttpResponse(
-            json.dumps({"error": error_msg}),
-            status_code=502,
-            mimetype="application/json"
-        )
-    except Exception as e:
-        error_msg = f"Internal server error: {str(e)}"
+    # Allowlist check
+    if not is_allowed(target_url):
+        error_msg = f"Endpoint not allowed: {target_url}"
         logging.error(error_msg)
-        return func.HttpResponse(
-            json.dumps({"error": error_msg}),
-            status_code=500,
-            mimetype="application/json"
-        )
+        return _json_error(error_msg, 403)
+
+    # Query parameters (exclude our special parameter)
+    query_params = [(k, v) for k, v in req.params.items() if k != '__proxy_scheme']
+    return _do_proxy(req, method, target_url, query_params)
 
 @app.route(route="odata/{*endpoint}", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET", "POST"])
+@_safe_handler("Unexpected error in OData proxy")
 def odata_proxy_function(req: func.HttpRequest) -> func.HttpResponse:
-    try:
-        endpoint = req.route_params.get('endpoint')
-        if not endpoint:
-            error_msg = "No OData endpoint specified"
-            logging.error(error_msg)
-            return func.HttpResponse(
-                json.dumps({"error": error_msg}),
-                status_code=400,
-                mimetype="application/json"
-            )
-
-        if endpoint.startswith("http://") or endpoint.startswith("https://"):
-            target_url = endpoint
-        else:
-            target_url = f"https://{endpoint}"
+    method = req.method.upper()
+    endpoint = req.route_params.get('endpoint')
+    if not endpoint:
+        error_msg = "No OData endpoint specified"
+        logging.error(error_msg)
+        return _json_error(error_msg, 400)
 
-        if not is_allowed(target_url):
-            error_msg = f"OData endpoint not allowed: {target_url}"
-            logging.error(error_msg)
-            return func.HttpResponse(
-                json.dumps({"error": error_msg}),
-                status_code=403,
-                mimetype="application/json"
-            )
-
-        query_params = dict(req.params)
-        if query_params:
-            delimiter = "&" if "?" in target_url else "?"
-            target_url += delimiter + urlencode(query_params)
-
-        method = req.method.upper()
-
-        # OData-specific headers
-        headers = {
-            'Accept': 'application/json;odata.metadata=minimal',
-            'Content-Type': 'application/json',
-            'OData-Version': '4.0'
-        }
-        for key, value in req.headers.items():
-            if key.lower() not in ['host', 'connection', 'content-length', 'transfer-encoding', 'accept', 'content-type']:
-                headers[key] = value
-
-        body = None
-        if method == 'POST':
-            try:
-                body = req.get_body()
-            except Exception as e:
-                logging.warning(f"Could not read request body: {e}")
-
-        logging.info(f"Proxying OData {method} request to: {target_url}")
-
-        response = requests.request(
-            method=method,
-            url=target_url,
-            headers=headers,
-            data=body,
-            timeout=30,
-            verify=target_url.startswith("https://")
-        )
-
-        response_headers = {}
-        for key, value in response.headers.items():
-            if key.lower() not in ['content-encoding', 'content-length', 'transfer-encoding', 'connection']:
-                response_headers[key] = value
-
-        return func.HttpResponse(
-            body=response.content,
-            status_code=response.status_code,
-            headers=response_headers,
-            mimetype=response.headers.get('content-type', 'application/json')
-        )
+    if endpoint.startswith(("http://", "https://")):
+        target_url = endpoint
+    else:
+        target_url = f"https://{endpoint}"
 
-    except requests.exceptions.RequestException as e:
-        error_msg = f"OData request failed: {str(e)}"
+    if not is_allowed(target_url):
+        error_msg = f"OData endpoint not allowed: {target_url}"
         logging.error(error_msg)
-        return func.HttpResponse(
-            json.dumps({"error": error_msg}),
-            status_code=502,
-            mimetype="application/json"
-        )
-    except Exception as e:
-        error_msg = f"Unexpected error in OData proxy: {str(e)}"
-        logging.error(error_msg)
-        return func.HttpResponse(
-            json.dumps({"error": error_msg}),
-            status_code=500,
-            mimetype="application/json"
-        )
+        return _json_error(error_msg, 403)
+
+    return _do_proxy(
+        req, method, target_url, req.params,
+        label="OData ",
+        request_error="OData request failed",
+        base_headers=_ODATA_HEADERS,
+        excluded_headers=_HOP_BY_HOP_REQ_ODATA
+    )
 
 @app.route(route="health", auth_level=func.AuthLevel.ANONYMOUS)
 def health_check(req: func.HttpRequest) -> func.HttpResponse:
     return func.HttpResponse(
-        json.dumps({"status": "healthy"}),
+        _HEALTHY_BODY,
         status_code=200,
         mimetype="application/json"
     )